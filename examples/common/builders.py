@@ -98,13 +98,15 @@ def build_optimizer(cfg, model):
         return DecoupledLionW(model.parameters(),
                               lr=cfg.lr,
                               betas=cfg.betas,
-                              weight_decay=cfg.weight_decay)
+                              weight_decay=cfg.weight_decay,
+                              bf16_moment=cfg.get('bf16_moment', False))
     elif cfg.name == 'clip_lion':
         return DecoupledClipLion(model.parameters(),
                                  lr=cfg.lr,
                                  betas=cfg.betas,
                                  weight_decay=cfg.weight_decay,
-                                 outlier_threshold=cfg.outlier_threshold)
+                                 outlier_threshold=cfg.outlier_threshold,
+                                 bf16_moment=cfg.get('bf16_moment', False))
     elif cfg.name == 'adalr_lion':
         return DecoupledAdaLRLion(model.parameters(),
                                   lr=cfg.lr,
@@ -113,7 +115,8 @@ def build_optimizer(cfg, model):
                                   outlier_threshold=cfg.outlier_threshold,
                                   timeout=cfg.timeout,
                                   lr_penalty=cfg.lr_penalty,
-                                  min_scale=cfg.min_scale)
+                                  min_scale=cfg.min_scale,
+                                  bf16_moment=cfg.get('bf16_moment', False))
     else:
         raise ValueError(f'Not sure how to build optimizer: {cfg.name}')
 
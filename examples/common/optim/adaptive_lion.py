@@ -1,45 +1,47 @@
-from typing import Tuple, Optional, Callable
+from typing import Any, List, NamedTuple, Tuple, Optional, Callable
+from examples.common.optim.lion import DecoupledLionW, _bucket_params, _dist_reduce_metrics, _multi_tensor_lionw
 from examples.common.optim.outlier_detection import OutlierDetector
 import torch
-from torch.optim.optimizer import Optimizer
-import logging
-import math
+import torch.distributed as torch_dist
+import abc
+import collections
 from composer.utils import dist
 
-log = logging.getLogger(__name__)
 
-class DecoupledAdaLRLion(Optimizer):
-    """This class implements a variant of Lion which lowers the layerwise learning rate when the layer's moment becomes an outlier. A moment is an outlier if it is some multiple
-    `outlier_threshold` times larger than the simple windowed moving average (MVA) of moment norms taken from steps T-1000 to T-500. If an outlier is detected, the LR is lowered by `lr_penalty` for `timeout` steps.
-    If N outliers are detected within `timeout` steps, the LR is scaled down by min(`lr_penalty` ** N, `min_scale`).
+class _Bucket(NamedTuple):
+    """A bucket of params whose observed norms are being summed across ranks, waiting to be updated."""
+    group: dict
+    params: List[torch.Tensor]
+    states: List[dict]
+    grads: List[torch.Tensor]
+    exp_avgs: List[torch.Tensor]
+    # the moments the params will have after this step, if the subclass computed them for outlier detection
+    next_exp_avgs: Optional[List[torch.Tensor]]
+    # squared norms of the observed tensors, summed across ranks once `handle` completes
+    norms: torch.Tensor
+    handle: Optional[Any]
+
+
+class BaseOutlierLion(DecoupledLionW, metaclass=abc.ABCMeta):
+    """Base class for the Lion variants that track the layerwise norm of some tensor and react when it becomes an outlier
+    relative to its moving average.
+
+    The base class owns the update and the bucketing and communication of the tracked norms, and inherits the metrics
+    from `DecoupledLionW`. Subclasses choose which tensor is tracked and what happens to an outlier by implementing
+    `_init_outlier_state`, `_observed_tensors`, `_apply_outlier_policy` and `_report_outlier_metrics`.
 
     Args:
         params (Iterable[torch.Parameter]): Model parameters to optimize
         lr (float): Learning rate for updates
         betas (Tuple[float]): Momentum factors
         weight_decay (float): Weight decay
-        outlier_threshold (float): Multiplicative factor determining what constitutes an "outlier" relative to the MVA of gradient norms.
-        timeout (int): Number of steps to lower the learning for after seeing an outlier.
-        lr_penalty (float): Multiplicative scale by which to lower the LR for each outlier.
-        min_scale (float): Minimum allowed scaling of the LR .
-
+        outlier_threshold (float): Multiplicative factor determining what constitutes an "outlier" relative to the MVA of the tracked norms.
+        bf16_moment (bool): Whether to store the moment in bfloat16, halving its memory footprint and traffic. The update
+            itself is still computed in the parameter's precision.
     """
-    metric_functions = {
-        'l2_norm/moment':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(optim_state['exp_avg']),
-        'l2_norm/param':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(param.data),
-        'l2_norm/update':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(step_tensor),
-        'l2_norm/grad':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(param.grad),
-        'cosine/update_grad':
-            lambda param, optim_state, step_tensor: torch.nn.functional.cosine_similarity(
-                param.grad.flatten(), step_tensor.flatten(), dim=0),
-        'cosine/moment_grad':
-            lambda param, optim_state, step_tensor: torch.nn.functional.cosine_similarity(
-                param.grad.flatten(), optim_state['exp_avg'].flatten(), dim=0),
-    }
+
+    # metrics with this prefix are local to each rank and are not reduced
+    _local_metric_prefix: Optional[str] = None
 
     def __init__(
         self,
@@ -48,62 +50,29 @@ class DecoupledAdaLRLion(Optimizer):
         betas: Tuple[float, float] = (0.9, 0.99),
         weight_decay: float = 0.0,
         outlier_threshold: float = 10.0,
-        timeout: int = 100,
-        lr_penalty: float = .707,
-        min_scale: float = 1e-4
+        bf16_moment: bool = False
     ):
-        if lr <= 0.:
-            raise Exception(f"Invalid LR: {lr}. LR must be > 0")
-        if not all([0. <= beta <= 1. for beta in betas]):
-            raise Exception(f"Invalid beta values: {betas} All betas must be between 0 and 1.")
-        if weight_decay >= 1e-3:
-            log.warning(
-                f'You are using a high value of `weight_decay={weight_decay}` for the `DecoupledLionW` optimizer. Are you sure you want to do this? '
-                f'Your model\'s weights will be multiplied by {1.0 - weight_decay} on every step!')
-
-        defaults = dict(
-            lr = lr,
-            betas = betas,
-            weight_decay = weight_decay
-        )
-
-        super().__init__(params, defaults)
-        
-        for group in self.param_groups:
-            group['initial_lr'] = group['lr']
-        self.outlier_threshold = outlier_threshold
-        self.timeout = timeout
-        self.lr_penalty = lr_penalty
-        self.min_scale = min_scale
+        super().__init__(params, lr=lr, betas=betas, weight_decay=weight_decay, bf16_moment=bf16_moment)
 
-    @staticmethod
-    def lionw(p, grad, exp_avg, lr, initial_lr, wd, beta1, beta2) -> None:
-        # stepweight decay
-        if wd != 0:
-            decay_factor = (lr / initial_lr) if initial_lr else 1.0
-            p.data.mul_(1 - decay_factor * wd)
-
-        # update is interpolation between gradient and momentum
-        update = exp_avg.lerp(grad, 1 - beta1).sign_()
-        p.add_(update, alpha = -lr)
+        self.outlier_threshold = outlier_threshold
 
-        # momentum is interp b/w gradient and itself
-        exp_avg.lerp_(grad, 1 - beta2)
+    @abc.abstractmethod
+    def _init_outlier_state(self, state: dict) -> None:
+        """Adds the subclass's outlier tracking entries to a parameter's freshly created state."""
 
-    @staticmethod
-    def adjust_lr(lr: float, lr_penalty: float, num_times: int, min_scale: float):
-        """Multiplicatively scales down the LR by lr_penalty for each outlier that has occurred in the last `timeout` number of steps, capping the scaling to be no smaller than `min_scale`.
+    @abc.abstractmethod
+    def _observed_tensors(self, group: dict, grads: List[torch.Tensor], exp_avgs: List[torch.Tensor]) -> Tuple[List[torch.Tensor], Optional[List[torch.Tensor]]]:
+        """Returns the tensors whose norms are checked for outliers and, if they had to be computed for that, the moments
+        the params will have after this step, which then replace the current ones."""
 
-        Args:
-            lr (float): Base learning rate
-            lr_penalty (float): Scaling factor to multiply by for each outlier
-            num_times (int): Number of outliers in the last `timeout` steps
-            min_scale (float): Minimum scaling to apply to our LR.
+    @abc.abstractmethod
+    def _apply_outlier_policy(self, group: dict, states: List[dict], grads: List[torch.Tensor], norms: List[float]) -> List[float]:
+        """Feeds the observed norms to the outlier trackers in the params' `states` and returns the learning rate of
+        each param. Entries of `grads` may be replaced by the grads to update with."""
 
-        Returns:
-            float: Scaled LR
-        """
-        return lr * max(min_scale, lr_penalty ** num_times)
+    @abc.abstractmethod
+    def _report_outlier_metrics(self, state: dict, name: str, optimizer_metrics: dict) -> None:
+        """Adds the subclass's rank-local metrics for a parameter."""
 
     @torch.no_grad()
     def step(
@@ -115,136 +84,82 @@ class DecoupledAdaLRLion(Optimizer):
         if closure is not None:
             with torch.enable_grad():
                 loss = closure()
-        
+
+        world_size = dist.get_world_size()
+
+        # buckets are pipelined: while one bucket's observed norms are summed across ranks, the next bucket's are
+        # computed. Buckets are capped in size, so at most two buckets' worth of new moments are alive at once
+        pending = None
         for group in self.param_groups:
-            for p in filter(lambda p: p.grad is not None and p.requires_grad, group['params']):
-
-                grad, lr, initial_lr, wd, beta1, beta2, state = p.grad, group['lr'], group['initial_lr'], group['weight_decay'], *group['betas'], self.state[p]
-
-                # init state - exponential moving average of gradient values
-
-                if len(state) == 0:
-                    state['exp_avg'] = torch.zeros_like(p)
-                    state['moment_tracker'] = OutlierDetector(self.outlier_threshold)
-                    state['outlier_timestamp'] = []
-                    state['step'] = 0
-
-                exp_avg = state['exp_avg']
-
-                # determine if the new moment resulting from this grad would be an outlier
-                moment_norm = torch.linalg.vector_norm(
-                    exp_avg.lerp(grad, 1 - beta2)
-                ) ** 2
-
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(moment_norm, reduce_operation='SUM')
-                moment_norm = math.sqrt(moment_norm)
-
-                if state['moment_tracker'].insert_observation(moment_norm):
-                    state['outlier_timestamp'].append(state['step'])
-                
-                removed = []
-                for ts in state['outlier_timestamp']:
-                    if state['step'] - ts > self.timeout:
-                        removed.append(ts)
-                
-                for ts in removed:
-                    state['outlier_timestamp'].remove(ts)
-                
-                lr = self.adjust_lr(lr, self.lr_penalty, len(state['outlier_timestamp']), self.min_scale)
-                self.lionw(
-                        p,
-                        grad,
-                        exp_avg,
-                        lr,
-                        initial_lr,
-                        wd,
-                        beta1,
-                        beta2
-                )
-                state['step'] += 1
+            params = [p for p in group['params'] if p.grad is not None and p.requires_grad]
+            for params in _bucket_params(params):
+                # each param's state is looked up once per step and handed down with it
+                states = [self.state[p] for p in params]
+                for p, state in zip(params, states):
+                    # init state - exponential moving average of gradient values
 
+                    if len(state) == 0:
+                        state['exp_avg'] = torch.zeros_like(p, dtype=torch.bfloat16 if self.bf16_moment else None)
+                        self._init_outlier_state(state)
 
-        return loss
+                bucket = self._prepare_bucket(group, params, states, world_size)
+                if pending is not None:
+                    self._update_bucket(pending)
+                pending = bucket
 
-    def dist_reduce_metrics(self, optimizer_metrics):
-        for metric in optimizer_metrics:
-            if metric.startswith('l2_norm'):
-                reduced = optimizer_metrics[metric]
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(reduced, reduce_operation='SUM')
-
-                optimizer_metrics[metric] = math.sqrt(reduced)
-            elif metric.startswith('cosine'):
-                reduced = optimizer_metrics[metric]
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(reduced, reduce_operation='SUM')
-
-                _, vectors, layer = tuple(metric.split('/'))
-
-                A, B = tuple(vectors.split('_'))
-
-                A_reduced_norm = optimizer_metrics[f'l2_norm/{A}/{layer}']
-                B_reduced_norm = optimizer_metrics[f'l2_norm/{B}/{layer}']
-                optimizer_metrics[metric] = reduced / (A_reduced_norm * B_reduced_norm)
-            elif metric.startswith('layerwise_lr'):
-                continue
-            else:
-                reduced = optimizer_metrics[metric]
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(reduced, reduce_operation='SUM')
-                optimizer_metrics[metric] = reduced / dist.get_world_size()
+        if pending is not None:
+            self._update_bucket(pending)
 
-        return optimizer_metrics
+        return loss
 
-    def pre_reduce_metrics(self, optimizer_metrics):
-        """Preprocess metrics to reduce across ranks correctly."""
-        # Sort L2 norms first so they are squared before other metrics, which depend on squared values
-        metrics = optimizer_metrics.keys()
-        metrics = sorted(metrics, key=lambda metric: 0 if 'l2_norm' in metric else 1)
-        for metric in metrics:
-            if metric.startswith('l2_norm'):
-                # L2 norms need to be squared, before they are reduced via summation
-                optimizer_metrics[metric] = optimizer_metrics[metric]**2
-            elif metric.startswith('cosine'):
-                _, vectors, layer = tuple(metric.split('/'))
+    def _prepare_bucket(self, group: dict, params: List[torch.Tensor], states: List[dict], world_size: int) -> _Bucket:
+        """Computes the squared norms of the tensors observed for `params` and starts summing them across ranks."""
+        grads = [p.grad for p in params]
+        exp_avgs = [state['exp_avg'] for state in states]
 
-                A, B = tuple(vectors.split('_'))
+        observed, next_exp_avgs = self._observed_tensors(group, grads, exp_avgs)
+        norms = torch.stack(torch._foreach_norm(observed)).float().pow_(2)
+        handle = torch_dist.all_reduce(norms, async_op=True) if world_size > 1 else None
 
-                # L2 norm would've been squared in previous branch
-                A_rank_subset_norm = math.sqrt(optimizer_metrics[f'l2_norm/{A}/{layer}'])
-                B_rank_subset_norm = math.sqrt(optimizer_metrics[f'l2_norm/{B}/{layer}'])
+        return _Bucket(group, params, states, grads, exp_avgs, next_exp_avgs, norms, handle)
 
-                optimizer_metrics[metric] *= A_rank_subset_norm * B_rank_subset_norm
+    def _update_bucket(self, bucket: _Bucket) -> None:
+        """Applies the outlier policy to the observed norms and updates the parameters and moments."""
+        group, params, grads, exp_avgs = bucket.group, bucket.params, bucket.grads, bucket.exp_avgs
+        initial_lr, wd, beta1, beta2 = group['initial_lr'], group['weight_decay'], *group['betas']
 
-        return optimizer_metrics
+        if bucket.handle is not None:
+            bucket.handle.wait()
+        # take the square roots on device and copy the bucket's norms to host with a single sync
+        norms = bucket.norms.sqrt_().tolist()
 
-    def report_per_parameter_metrics(self, param: torch.Tensor, name: str, optimizer_metrics: dict):
-        lr = self.param_groups[0]['lr']
-        weight_decay = self.param_groups[0]['weight_decay']
-        initial_lr = self.param_groups[0]['initial_lr']
+        lrs = self._apply_outlier_policy(group, bucket.states, grads, norms)
 
-        beta1, _ = self.param_groups[0]['betas']
-        if param in self.state:
-            param_optim_state = self.state[param]
-            layerwise_lr = self.adjust_lr(lr, self.lr_penalty, len(param_optim_state['outlier_timestamp']), self.min_scale)
+        if bucket.next_exp_avgs is None:
+            _multi_tensor_lionw(params, grads, exp_avgs, lrs, initial_lr, wd, beta1, beta2)
+            return
 
-            step_tensor =  param_optim_state['exp_avg'].clone().lerp_(param.grad, 1 - beta1).sign_().mul_(lr)
-            decay_factor = (lr / initial_lr) if initial_lr else 1.0
-            step_tensor.add_(param, alpha=-weight_decay * decay_factor)
-            for metric in self.metric_functions:
-                optimizer_metrics[f'{metric}/{name}'] = self.metric_functions[metric](param, param_optim_state,
-                                                                                      step_tensor)
+        # the new moments were already computed for outlier detection, so they replace the old ones
+        # instead of being recomputed by the update
+        _multi_tensor_lionw(params, grads, exp_avgs, lrs, initial_lr, wd, beta1, beta2, update_moment=False)
+        for state, next_exp_avg in zip(bucket.states, bucket.next_exp_avgs):
+            state['exp_avg'] = next_exp_avg
 
-            optimizer_metrics[f'layerwise_lr/{name}'] = torch.tensor(layerwise_lr)
+    def dist_reduce_metrics(self, optimizer_metrics):
+        return _dist_reduce_metrics(optimizer_metrics, skip_prefix=self._local_metric_prefix)
+
+    def report_per_parameter_metrics(self, param: torch.Tensor, name: str, optimizer_metrics: dict):
+        optimizer_metrics = super().report_per_parameter_metrics(param, name, optimizer_metrics)
+        if param in self.state:
+            self._report_outlier_metrics(self.state[param], name, optimizer_metrics)
 
         return optimizer_metrics
 
 
-class DecoupledClipLion(Optimizer):
-    """This class implements a variant of Lion which clips layerwise gradients that are "outliers". A gradient is an outlier if it is some multiple
-    k times larger than the simple windowed moving average (MVA) of gradient norms taken from steps T-1000 to T-500. If an outlier is detected, it is clipped
-    to no longer have norm k * MVA.
+class DecoupledAdaLRLion(BaseOutlierLion):
+    """This class implements a variant of Lion which lowers the layerwise learning rate when the layer's moment becomes an outlier. A moment is an outlier if it is some multiple
+    `outlier_threshold` times larger than the simple windowed moving average (MVA) of moment norms taken from steps T-1000 to T-500. If an outlier is detected, the LR is lowered by `lr_penalty` for `timeout` steps.
+    If N outliers are detected within `timeout` steps, the LR is scaled down by min(`lr_penalty` ** N, `min_scale`).
 
     Args:
         params (Iterable[torch.Parameter]): Model parameters to optimize
@@ -252,23 +167,15 @@ class DecoupledClipLion(Optimizer):
         betas (Tuple[float]): Momentum factors
         weight_decay (float): Weight decay
         outlier_threshold (float): Multiplicative factor determining what constitutes an "outlier" relative to the MVA of gradient norms.
+        timeout (int): Number of steps to lower the learning for after seeing an outlier.
+        lr_penalty (float): Multiplicative scale by which to lower the LR for each outlier.
+        min_scale (float): Minimum allowed scaling of the LR .
+        bf16_moment (bool): Whether to store the moment in bfloat16, halving its memory footprint and traffic. The update
+            itself is still computed in the parameter's precision.
+
     """
-    metric_functions = {
-        'l2_norm/moment':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(optim_state['exp_avg']),
-        'l2_norm/param':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(param.data),
-        'l2_norm/update':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(step_tensor),
-        'l2_norm/grad':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(param.grad),
-        'cosine/update_grad':
-            lambda param, optim_state, step_tensor: torch.nn.functional.cosine_similarity(
-                param.grad.flatten(), step_tensor.flatten(), dim=0),
-        'cosine/moment_grad':
-            lambda param, optim_state, step_tensor: torch.nn.functional.cosine_similarity(
-                param.grad.flatten(), optim_state['exp_avg'].flatten(), dim=0),
-    }
+
+    _local_metric_prefix = 'layerwise_lr'
 
     def __init__(
         self,
@@ -276,163 +183,123 @@ class DecoupledClipLion(Optimizer):
         lr: float = 1e-4,
         betas: Tuple[float, float] = (0.9, 0.99),
         weight_decay: float = 0.0,
-        outlier_threshold = 5.0
+        outlier_threshold: float = 10.0,
+        timeout: int = 100,
+        lr_penalty: float = .707,
+        min_scale: float = 1e-4,
+        bf16_moment: bool = False
     ):
-        if lr <= 0.:
-            raise Exception(f"Invalid LR: {lr}. LR must be > 0")
-        if not all([0. <= beta <= 1. for beta in betas]):
-            raise Exception(f"Invalid beta values: {betas} All betas must be between 0 and 1.")
-        if weight_decay >= 1e-3:
-            log.warning(
-                f'You are using a high value of `weight_decay={weight_decay}` for the `DecoupledLionW` optimizer. Are you sure you want to do this? '
-                f'Your model\'s weights will be multiplied by {1.0 - weight_decay} on every step!')
-
-        defaults = dict(
-            lr = lr,
-            betas = betas,
-            weight_decay = weight_decay
-        )
-
-        super().__init__(params, defaults)
-        
-        for group in self.param_groups:
-            group['initial_lr'] = group['lr']
-        self.outlier_threshold = outlier_threshold
+        super().__init__(params, lr=lr, betas=betas, weight_decay=weight_decay, outlier_threshold=outlier_threshold, bf16_moment=bf16_moment)
+
+        self.timeout = timeout
+        self.lr_penalty = lr_penalty
+        self.min_scale = min_scale
+        # at most `timeout` + 1 outliers can be live at once, so every possible LR scaling fits in a small table
+        self._lr_scales = [max(min_scale, lr_penalty ** num_times) for num_times in range(timeout + 2)]
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # older checkpoints store the outlier timestamps in a list
+        for param_state in self.state.values():
+            if isinstance(param_state.get('outlier_timestamp'), list):
+                param_state['outlier_timestamp'] = collections.deque(param_state['outlier_timestamp'])
 
     @staticmethod
-    def lionw(p, grad, exp_avg, lr, initial_lr, wd, beta1, beta2) -> None:
-        # stepweight decay
-        if wd != 0:
-            decay_factor = (lr / initial_lr) if initial_lr else 1.0
-            p.data.mul_(1 - decay_factor * wd)
+    def adjust_lr(lr: float, lr_penalty: float, num_times: int, min_scale: float):
+        """Multiplicatively scales down the LR by lr_penalty for each outlier that has occurred in the last `timeout` number of steps, capping the scaling to be no smaller than `min_scale`.
 
-        # update is interpolation between gradient and momentum
-        update = exp_avg.lerp(grad, 1 - beta1).sign_()
-        p.add_(update, alpha = -lr)
+        Args:
+            lr (float): Base learning rate
+            lr_penalty (float): Scaling factor to multiply by for each outlier
+            num_times (int): Number of outliers in the last `timeout` steps
+            min_scale (float): Minimum scaling to apply to our LR.
 
-        # momentum is interp b/w gradient and itself
-        exp_avg.lerp_(grad, 1 - beta2)
+        Returns:
+            float: Scaled LR
+        """
+        return lr * max(min_scale, lr_penalty ** num_times)
 
-    @torch.no_grad()
-    def step(
-        self,
-        closure: Optional[Callable] = None
-    ):
+    def _scaled_lr(self, lr: float, num_times: int) -> float:
+        """`adjust_lr` with this optimizer's `lr_penalty` and `min_scale`, looked up from the precomputed table."""
+        return lr * self._lr_scales[num_times]
 
-        loss = None
-        if closure is not None:
-            with torch.enable_grad():
-                loss = closure()
-        
-        for group in self.param_groups:
-            for p in filter(lambda p: p.grad is not None and p.requires_grad, group['params']):
-
-                grad, lr, initial_lr, wd, beta1, beta2, state = p.grad, group['lr'], group['initial_lr'], group['weight_decay'], *group['betas'], self.state[p]
-
-                # init state - exponential moving average of gradient values
-
-                if len(state) == 0:
-                    state['exp_avg'] = torch.zeros_like(p)
-                    state['grad_tracker'] = OutlierDetector(self.outlier_threshold)
-                    state['clipped_batches'] = torch.tensor(0.0)
-
-                exp_avg = state['exp_avg']
-
-                # determine if the new moment resulting from this grad would be an outlier
-                grad_norm = torch.linalg.vector_norm(
-                    grad
-                ) ** 2
-
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(grad_norm, reduce_operation='SUM')
-                grad_norm = math.sqrt(grad_norm)
-
-                if state['grad_tracker'].insert_observation(grad_norm):
-                    state['clipped_batches'] += 1.0
-                    clip_norm = state['grad_tracker'].get_slow_mva() * self.outlier_threshold
-                    grad = grad.div(grad_norm).mul_(clip_norm) 
-                
-                self.lionw(
-                        p,
-                        grad,
-                        exp_avg,
-                        lr,
-                        initial_lr,
-                        wd,
-                        beta1,
-                        beta2
-                )
+    def _init_outlier_state(self, state):
+        state['moment_tracker'] = OutlierDetector(self.outlier_threshold)
+        state['outlier_timestamp'] = collections.deque()
+        state['step'] = 0
 
-        return loss
+    def _observed_tensors(self, group, grads, exp_avgs):
+        # the tracked moment is the one the params will have after this step
+        beta2 = group['betas'][1]
+        next_exp_avgs = torch._foreach_mul(exp_avgs, beta2)
+        torch._foreach_add_(next_exp_avgs, grads, alpha = 1 - beta2)
+        return next_exp_avgs, next_exp_avgs
 
-    def dist_reduce_metrics(self, optimizer_metrics):
-        for metric in optimizer_metrics:
-            if metric.startswith('l2_norm'):
-                reduced = optimizer_metrics[metric]
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(reduced, reduce_operation='SUM')
-
-                optimizer_metrics[metric] = math.sqrt(reduced)
-            elif metric.startswith('cosine'):
-                reduced = optimizer_metrics[metric]
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(reduced, reduce_operation='SUM')
-
-                _, vectors, layer = tuple(metric.split('/'))
-
-                A, B = tuple(vectors.split('_'))
-
-                A_reduced_norm = optimizer_metrics[f'l2_norm/{A}/{layer}']
-                B_reduced_norm = optimizer_metrics[f'l2_norm/{B}/{layer}']
-                optimizer_metrics[metric] = reduced / (A_reduced_norm * B_reduced_norm)
-            elif metric.startswith('clipped_batches'):
-                continue
-            else:
-                reduced = optimizer_metrics[metric]
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(reduced, reduce_operation='SUM')
-                optimizer_metrics[metric] = reduced / dist.get_world_size()
+    def _apply_outlier_policy(self, group, states, grads, norms):
+        lr = group['lr']
+        lrs = []
+        for state, moment_norm in zip(states, norms):
+            if state['moment_tracker'].insert_observation(moment_norm):
+                state['outlier_timestamp'].append(state['step'])
 
-        return optimizer_metrics
+            # timestamps are appended in order, so expired ones are always at the front
+            outlier_timestamp = state['outlier_timestamp']
+            while outlier_timestamp and state['step'] - outlier_timestamp[0] > self.timeout:
+                outlier_timestamp.popleft()
 
-    def pre_reduce_metrics(self, optimizer_metrics):
-        """Preprocess metrics to reduce across ranks correctly."""
-        # Sort L2 norms first so they are squared before other metrics, which depend on squared values
-        metrics = optimizer_metrics.keys()
-        metrics = sorted(metrics, key=lambda metric: 0 if 'l2_norm' in metric else 1)
-        for metric in metrics:
-            if metric.startswith('l2_norm'):
-                # L2 norms need to be squared, before they are reduced via summation
-                optimizer_metrics[metric] = optimizer_metrics[metric]**2
-            elif metric.startswith('cosine'):
-                _, vectors, layer = tuple(metric.split('/'))
+            lrs.append(self._scaled_lr(lr, len(state['outlier_timestamp'])))
+            state['step'] += 1
 
-                A, B = tuple(vectors.split('_'))
+        return lrs
 
-                # L2 norm would've been squared in previous branch
-                A_rank_subset_norm = math.sqrt(optimizer_metrics[f'l2_norm/{A}/{layer}'])
-                B_rank_subset_norm = math.sqrt(optimizer_metrics[f'l2_norm/{B}/{layer}'])
+    def _report_outlier_metrics(self, state, name, optimizer_metrics):
+        layerwise_lr = self._scaled_lr(self.param_groups[0]['lr'], len(state['outlier_timestamp']))
+        optimizer_metrics[f'layerwise_lr/{name}'] = torch.tensor(layerwise_lr)
 
-                optimizer_metrics[metric] *= A_rank_subset_norm * B_rank_subset_norm
 
-        return optimizer_metrics
+class DecoupledClipLion(BaseOutlierLion):
+    """This class implements a variant of Lion which clips layerwise gradients that are "outliers". A gradient is an outlier if it is some multiple
+    k times larger than the simple windowed moving average (MVA) of gradient norms taken from steps T-1000 to T-500. If an outlier is detected, it is clipped
+    to no longer have norm k * MVA.
 
-    def report_per_parameter_metrics(self, param: torch.Tensor, name: str, optimizer_metrics: dict):
-        lr = self.param_groups[0]['lr']
-        weight_decay = self.param_groups[0]['weight_decay']
-        initial_lr = self.param_groups[0]['initial_lr']
+    Args:
+        params (Iterable[torch.Parameter]): Model parameters to optimize
+        lr (float): Learning rate for updates
+        betas (Tuple[float]): Momentum factors
+        weight_decay (float): Weight decay
+        outlier_threshold (float): Multiplicative factor determining what constitutes an "outlier" relative to the MVA of gradient norms.
+        bf16_moment (bool): Whether to store the moment in bfloat16, halving its memory footprint and traffic. The update
+            itself is still computed in the parameter's precision.
+    """
 
-        beta1, _ = self.param_groups[0]['betas']
-        if param in self.state:
-            param_optim_state = self.state[param]
-            step_tensor =  param_optim_state['exp_avg'].clone().lerp_(param.grad, 1 - beta1).sign_().mul_(lr)
-            decay_factor = (lr / initial_lr) if initial_lr else 1.0
-            step_tensor.add_(param, alpha=-weight_decay * decay_factor)
-            for metric in self.metric_functions:
-                optimizer_metrics[f'{metric}/{name}'] = self.metric_functions[metric](param, param_optim_state,
-                                                                                      step_tensor)
+    _local_metric_prefix = 'clipped_batches'
+
+    def __init__(
+        self,
+        params,
+        lr: float = 1e-4,
+        betas: Tuple[float, float] = (0.9, 0.99),
+        weight_decay: float = 0.0,
+        outlier_threshold = 5.0,
+        bf16_moment: bool = False
+    ):
+        super().__init__(params, lr=lr, betas=betas, weight_decay=weight_decay, outlier_threshold=outlier_threshold, bf16_moment=bf16_moment)
 
-            optimizer_metrics[f'clipped_batches/{name}'] = param_optim_state['clipped_batches']
+    def _init_outlier_state(self, state):
+        state['grad_tracker'] = OutlierDetector(self.outlier_threshold)
+        state['clipped_batches'] = 0
 
-        return optimizer_metrics
+    def _observed_tensors(self, group, grads, exp_avgs):
+        return grads, None
+
+    def _apply_outlier_policy(self, group, states, grads, norms):
+        for i, (state, grad_norm) in enumerate(zip(states, norms)):
+            if state['grad_tracker'].insert_observation(grad_norm):
+                state['clipped_batches'] += 1
+                clip_norm = state['grad_tracker'].get_delayed_mva() * self.outlier_threshold
+                grads[i] = grads[i].mul(clip_norm / grad_norm)
+
+        return [group['lr']] * len(states)
 
+    def _report_outlier_metrics(self, state, name, optimizer_metrics):
+        optimizer_metrics[f'clipped_batches/{name}'] = torch.tensor(float(state['clipped_batches']))
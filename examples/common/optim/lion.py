@@ -1,47 +1,277 @@
 # Copyright 2022 MosaicML Examples authors
 # SPDX-License-Identifier: Apache-2.0
 
+import functools
 import logging
-import math
-from typing import Callable, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 import torch
 from composer.utils import dist
 from torch.optim.optimizer import Optimizer
 
+try:
+    from examples.common.optim.lion_triton import lion_update_fn
+except ImportError:
+    lion_update_fn = None
+
 log = logging.getLogger(__name__)
 
 
-class DecoupledLionW(Optimizer):
-    metric_functions = {
+# upper bound on the size of a bucket's params. The temporaries that are the
+# size of a bucket (the update directions of the eager update, and
+# DecoupledAdaLRLion's new moments) are only alive for one or two buckets at a
+# time, so this also bounds the extra memory they take
+_BUCKET_BYTES = 64 * 1024 * 1024
+
+
+# params with fewer elements than this are updated with the multi-tensor
+# kernels rather than the fused Triton kernel. At this size a param's update
+# takes several times longer than a kernel launch, and a bucket holds at most
+# 16 fp32 (or 32 bf16) params that are this large
+_TRITON_MIN_NUMEL = 1024 * 1024
+
+
+def _bucket_params(
+        params: List[torch.Tensor],
+        bucket_bytes: int = _BUCKET_BYTES) -> List[List[torch.Tensor]]:
+    """Splits params into lists that can each be handled by a single
+    multi-tensor (`torch._foreach_*`) kernel.
+
+    Each list holds params of a single device and dtype that take up at most
+    `bucket_bytes` in total, unless it is a single param larger than that.
+    """
+    buckets = []
+    open_buckets = {}
+    for p in params:
+        key = (p.device, p.dtype)
+        size = p.numel() * p.element_size()
+        bucket, bucket_size = open_buckets.get(key, (None, 0))
+        if bucket is None or bucket_size + size > bucket_bytes:
+            bucket, bucket_size = [], 0
+            buckets.append(bucket)
+        bucket.append(p)
+        open_buckets[key] = (bucket, bucket_size + size)
+    return buckets
+
+
+def _multi_tensor_lionw(params: List[torch.Tensor],
+                        grads: List[torch.Tensor],
+                        exp_avgs: List[torch.Tensor],
+                        lrs: List[float],
+                        initial_lr: float,
+                        wd: float,
+                        beta1: float,
+                        beta2: float,
+                        update_moment: bool = True) -> None:
+    """Lion update for a list of params on the same device and of the same
+    dtype, with a learning rate per param.
+
+    If `update_moment` is False, only the params are updated and the moments
+    are left for the caller to advance.
+    """
+    # most groups (e.g. biases and norms) have no weight decay, so skip the
+    # per-param decay factors for them. Otherwise the decay is proportional to
+    # each param's lr, so the factor per unit of lr is computed only once
+    if wd == 0:
+        wd_muls = [1.0] * len(lrs)
+    elif initial_lr:
+        wd_per_lr = wd / initial_lr
+        wd_muls = [1 - lr * wd_per_lr for lr in lrs]
+    else:
+        wd_muls = [1 - wd] * len(lrs)
+
+    # the fused kernel streams each tensor through memory only once, but takes
+    # a launch per param. It is used for the large params, of which a bucket
+    # holds only a handful, and the many small ones (biases, norms, ...) are
+    # updated together by the multi-tensor kernels
+    if lion_update_fn is not None and params[0].is_cuda:
+        eager = []
+        for i, (p, grad, exp_avg) in enumerate(zip(params, grads, exp_avgs)):
+            if p.numel() < _TRITON_MIN_NUMEL or not (p.is_contiguous() and
+                                                    grad.is_contiguous() and
+                                                    exp_avg.is_contiguous()):
+                eager.append(i)
+                continue
+            lion_update_fn(p.data,
+                           grad,
+                           exp_avg,
+                           lrs[i],
+                           wd_muls[i],
+                           beta1,
+                           beta2,
+                           update_moment=update_moment)
+        if not eager:
+            return
+        if len(eager) < len(params):
+            params, grads, exp_avgs, lrs, wd_muls = (
+                [ts[i] for i in eager]
+                for ts in (params, grads, exp_avgs, lrs, wd_muls))
+
+    # stepweight decay
+    if wd != 0:
+        torch._foreach_mul_(params, wd_muls)
+
+    # update is interpolation between gradient and momentum. It is computed in
+    # the params' dtype, so that a lower precision moment doesn't also round
+    # the lr the update is scaled by
+    if exp_avgs[0].dtype != params[0].dtype:
+        updates = [exp_avg.to(params[0].dtype) for exp_avg in exp_avgs]
+        torch._foreach_mul_(updates, beta1)
+    else:
+        updates = torch._foreach_mul(exp_avgs, beta1)
+    torch._foreach_add_(updates, grads, alpha=1 - beta1)
+    for update in updates:
+        update.sign_()
+    torch._foreach_mul_(updates, [-lr for lr in lrs])
+    torch._foreach_add_(params, updates)
+
+    # momentum is interp b/w gradient and itself
+    if update_moment:
+        torch._foreach_mul_(exp_avgs, beta2)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta2)
+
+
+def _lion_metrics(param: torch.Tensor, exp_avg: torch.Tensor,
+                  sign: torch.Tensor, lr: float,
+                  decay: float) -> Dict[str, torch.Tensor]:
+    """Computes the per-parameter metrics reported by the Lion optimizers.
+
+    All norms come from a single multi-tensor kernel and are shared between the
+    metrics that need them. The reported step `lr * sign - decay * param` is
+    never materialized: every entry of `sign` is -1, 0 or 1, so its norm and
+    its cosine similarity with the grad follow from a handful of dot products.
+    """
+    p, grad = param.data.flatten(), param.grad.flatten()
+    exp_avg, sign = exp_avg.flatten(), sign.flatten()
+    moment_norm, param_norm, grad_norm = torch._foreach_norm([exp_avg, p, grad])
+
+    update_norm_sq = lr**2 * torch.count_nonzero(sign)
+    update_grad_dot = lr * torch.dot(sign, grad)
+    if decay != 0:
+        update_norm_sq = update_norm_sq - 2 * lr * decay * torch.dot(
+            sign, p) + decay**2 * param_norm**2
+        update_grad_dot = update_grad_dot - decay * torch.dot(p, grad)
+    update_norm = update_norm_sq.clamp_min(0).sqrt()
+
+    # cosine similarities use the same epsilon as
+    # torch.nn.functional.cosine_similarity
+    return {
         'l2_norm/moment':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(
-                optim_state['exp_avg']),
+            moment_norm,
         'l2_norm/param':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(
-                param.data),
+            param_norm,
         'l2_norm/update':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(
-                step_tensor),
+            update_norm,
         'l2_norm/grad':
-            lambda param, optim_state, step_tensor: torch.linalg.vector_norm(
-                param.grad),
+            grad_norm,
         'cosine/update_grad':
-            lambda param, optim_state, step_tensor: torch.nn.functional.
-            cosine_similarity(
-                param.grad.flatten(), step_tensor.flatten(), dim=0),
+            update_grad_dot / (grad_norm * update_norm).clamp_min(1e-8),
         'cosine/moment_grad':
-            lambda param, optim_state, step_tensor: torch.nn.functional.
-            cosine_similarity(
-                param.grad.flatten(), optim_state['exp_avg'].flatten(), dim=0),
+            torch.dot(grad, exp_avg) /
+            (grad_norm * moment_norm).clamp_min(1e-8),
     }
 
+
+@functools.lru_cache(maxsize=None)
+def _cosine_norm_metrics(metric: str) -> Tuple[str, str]:
+    """Returns the keys of the two L2 norm metrics that the `cosine/A_B/layer`
+    metric is normalized by.
+
+    Metric keys are the same on every step, so they are parsed once and cached.
+    """
+    _, vectors, layer = tuple(metric.split('/'))
+    A, B = tuple(vectors.split('_'))
+    return f'l2_norm/{A}/{layer}', f'l2_norm/{B}/{layer}'
+
+
+def _pre_reduce_metrics(optimizer_metrics: dict) -> dict:
+    """Prepares the metrics to be summed across ranks.
+
+    Cosines are turned back into dot products while the L2 norms are still
+    unsquared, so the norms never have to be recovered with square roots (and
+    host syncs). The L2 norms are squared afterwards.
+    """
+    for metric in optimizer_metrics:
+        if metric.startswith('cosine'):
+            A_norm, B_norm = _cosine_norm_metrics(metric)
+            optimizer_metrics[metric] *= optimizer_metrics[
+                A_norm] * optimizer_metrics[B_norm]
+
+    for metric in optimizer_metrics:
+        if metric.startswith('l2_norm'):
+            # L2 norms need to be squared, before they are reduced via summation
+            optimizer_metrics[metric] = optimizer_metrics[metric]**2
+
+    return optimizer_metrics
+
+
+def _dist_reduce_metrics(optimizer_metrics: dict,
+                         skip_prefix: Optional[str] = None) -> dict:
+    """Reduces the pre-reduced metrics across ranks with a single collective
+    and finalizes them.
+
+    Metrics starting with `skip_prefix` are local to each rank and left
+    untouched.
+    """
+    metrics = [
+        metric for metric in optimizer_metrics
+        if skip_prefix is None or not metric.startswith(skip_prefix)
+    ]
+    if len(metrics) == 0:
+        return optimizer_metrics
+
+    world_size = dist.get_world_size()
+    reduced = torch.stack([optimizer_metrics[metric] for metric in metrics])
+    if world_size > 1:
+        dist.all_reduce(reduced, reduce_operation='SUM')
+
+    index = {metric: i for i, metric in enumerate(metrics)}
+    l2_norms, cosines, averages = [], [], []
+    cosine_norms_a, cosine_norms_b = [], []
+    for metric, i in index.items():
+        if metric.startswith('l2_norm'):
+            l2_norms.append(i)
+        elif metric.startswith('cosine'):
+            A_norm, B_norm = _cosine_norm_metrics(metric)
+            cosines.append(i)
+            cosine_norms_a.append(index[A_norm])
+            cosine_norms_b.append(index[B_norm])
+        else:
+            averages.append(i)
+
+    # L2 norms were reduced squared, and cosines were reduced as dot products
+    # that need the reduced norms
+    reduced[l2_norms] = reduced[l2_norms].sqrt()
+    reduced[cosines] = reduced[cosines] / (reduced[cosine_norms_a] *
+                                           reduced[cosine_norms_b])
+    reduced[averages] = reduced[averages] / world_size
+
+    for metric, value in zip(metrics, reduced.unbind()):
+        optimizer_metrics[metric] = value
+
+    return optimizer_metrics
+
+
+class DecoupledLionW(Optimizer):
+    """Lion optimizer with decoupled weight decay.
+
+    Args:
+        params (Iterable[torch.Parameter]): Model parameters to optimize
+        lr (float): Learning rate for updates
+        betas (Tuple[float]): Momentum factors
+        weight_decay (float): Weight decay
+        bf16_moment (bool): Whether to store the moment in bfloat16, halving
+            its memory footprint and traffic. The update itself is still
+            computed in the parameter's precision.
+    """
+
     def __init__(
             self,
             params,
             lr: float = 1e-4,
             betas: Tuple[float, float] = (0.9, 0.99),
             weight_decay: float = 0.0,
+            bf16_moment: bool = False,
     ):
         if lr <= 0.:
             raise Exception(f"Invalid LR: {lr}. LR must be > 0")
@@ -49,7 +279,7 @@ class DecoupledLionW(Optimizer):
             raise Exception(f"Invalid beta values: {betas} All betas must be between 0 and 1.")
         if weight_decay >= 1e-3:
             log.warning(
-                f'You are using a high value of `weight_decay={weight_decay}` for the `DecoupledLionW` optimizer. Are you sure you want to do this? '
+                f'You are using a high value of `weight_decay={weight_decay}` for the `{type(self).__name__}` optimizer. Are you sure you want to do this? '
                 f'Your model\'s weights will be multiplied by {1.0 - weight_decay} on every step!'
             )
 
@@ -59,20 +289,22 @@ class DecoupledLionW(Optimizer):
 
         for group in self.param_groups:
             group['initial_lr'] = group['lr']
+        self.bf16_moment = bf16_moment
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        # Optimizer.load_state_dict casts floating point state to the dtype of
+        # its param, so bfloat16 moments come back in full precision
+        if self.bf16_moment:
+            for state in self.state.values():
+                if 'exp_avg' in state:
+                    state['exp_avg'] = state['exp_avg'].to(torch.bfloat16)
 
     @staticmethod
     def lionw(p, grad, exp_avg, lr, initial_lr, wd, beta1, beta2) -> None:
-        # stepweight decay
-        if wd != 0:
-            decay_factor = (lr / initial_lr) if initial_lr else 1.0
-            p.data.mul_(1 - decay_factor * wd)
-
-        # update is interpolation between gradient and momentum
-        update = exp_avg.lerp(grad, 1 - beta1).sign_()
-        p.add_(update, alpha=-lr)
-
-        # momentum is interp b/w gradient and itself
-        exp_avg.lerp_(grad, 1 - beta2)
+        """Lion update for a single param, see `_multi_tensor_lionw`."""
+        _multi_tensor_lionw([p], [grad], [exp_avg], [lr], initial_lr, wd, beta1,
+                            beta2)
 
     @torch.no_grad()
     def step(self, closure: Optional[Callable] = None):
@@ -83,78 +315,39 @@ class DecoupledLionW(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
-            for p in filter(lambda p: p.grad is not None and p.requires_grad,
-                            group['params']):
-
-                grad, lr, initial_lr, wd, beta1, beta2, state = p.grad, group[
-                    'lr'], group['initial_lr'], group[
-                        'weight_decay'], *group['betas'], self.state[p]
-
-                # init state - exponential moving average of gradient values
-
-                if len(state) == 0:
-                    state['exp_avg'] = torch.zeros_like(p)
-
-                exp_avg = state['exp_avg']
-
-                self.lionw(p, grad, exp_avg, lr, initial_lr, wd, beta1, beta2)
+            lr, initial_lr, wd, beta1, beta2 = group['lr'], group[
+                'initial_lr'], group['weight_decay'], *group['betas']
+            params = [
+                p for p in group['params']
+                if p.grad is not None and p.requires_grad
+            ]
+            for params in _bucket_params(params):
+                exp_avgs = []
+                for p in params:
+                    state = self.state[p]
+
+                    # init state - exponential moving average of gradient values
+
+                    if len(state) == 0:
+                        state['exp_avg'] = torch.zeros_like(
+                            p,
+                            dtype=torch.bfloat16 if self.bf16_moment else None)
+
+                    exp_avgs.append(state['exp_avg'])
+
+                grads = [p.grad for p in params]
+                _multi_tensor_lionw(params, grads, exp_avgs,
+                                    [lr] * len(params), initial_lr, wd, beta1,
+                                    beta2)
 
         return loss
 
     def dist_reduce_metrics(self, optimizer_metrics):
-        for metric in optimizer_metrics:
-            if metric.startswith('l2_norm'):
-                reduced = optimizer_metrics[metric]
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(reduced, reduce_operation='SUM')
-
-                optimizer_metrics[metric] = math.sqrt(reduced)
-            elif metric.startswith('cosine'):
-                reduced = optimizer_metrics[metric]
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(reduced, reduce_operation='SUM')
-
-                _, vectors, layer = tuple(metric.split('/'))
-
-                A, B = tuple(vectors.split('_'))
-
-                A_reduced_norm = optimizer_metrics[f'l2_norm/{A}/{layer}']
-                B_reduced_norm = optimizer_metrics[f'l2_norm/{B}/{layer}']
-                optimizer_metrics[metric] = reduced / (A_reduced_norm *
-                                                       B_reduced_norm)
-            else:
-                reduced = optimizer_metrics[metric]
-                if dist.get_world_size() > 1:
-                    dist.all_reduce(reduced, reduce_operation='SUM')
-                optimizer_metrics[metric] = reduced / dist.get_world_size()
-
-        return optimizer_metrics
+        return _dist_reduce_metrics(optimizer_metrics)
 
     def pre_reduce_metrics(self, optimizer_metrics):
         """Preprocess metrics to reduce across ranks correctly."""
-        # Sort L2 norms first so they are squared before other metrics, which depend on squared values
-        metrics = optimizer_metrics.keys()
-        metrics = sorted(metrics,
-                         key=lambda metric: 0 if 'l2_norm' in metric else 1)
-        for metric in metrics:
-            if metric.startswith('l2_norm'):
-                # L2 norms need to be squared, before they are reduced via summation
-                optimizer_metrics[metric] = optimizer_metrics[metric]**2
-            elif metric.startswith('cosine'):
-                _, vectors, layer = tuple(metric.split('/'))
-
-                A, B = tuple(vectors.split('_'))
-
-                # L2 norm would've been squared in previous branch
-                A_rank_subset_norm = math.sqrt(
-                    optimizer_metrics[f'l2_norm/{A}/{layer}'])
-                B_rank_subset_norm = math.sqrt(
-                    optimizer_metrics[f'l2_norm/{B}/{layer}'])
-
-                optimizer_metrics[
-                    metric] *= A_rank_subset_norm * B_rank_subset_norm
-
-        return optimizer_metrics
+        return _pre_reduce_metrics(optimizer_metrics)
 
     def report_per_parameter_metrics(self, param: torch.Tensor, name: str,
                                      optimizer_metrics: dict):
@@ -165,12 +358,12 @@ class DecoupledLionW(Optimizer):
         beta1, _ = self.param_groups[0]['betas']
         if param in self.state:
             param_optim_state = self.state[param]
-            step_tensor = param_optim_state['exp_avg'].clone().lerp_(
-                param.grad, 1 - beta1).sign_().mul_(lr)
+            exp_avg = param_optim_state['exp_avg'].to(param.dtype)
+            sign = torch.lerp(exp_avg, param.grad, 1 - beta1).sign_()
             decay_factor = (lr / initial_lr) if initial_lr else 1.0
-            step_tensor.add_(param, alpha=-weight_decay * decay_factor)
-            for metric in self.metric_functions:
-                optimizer_metrics[f'{metric}/{name}'] = self.metric_functions[
-                    metric](param, param_optim_state, step_tensor)
+            metrics = _lion_metrics(param, exp_avg, sign, lr,
+                                    weight_decay * decay_factor)
+            for metric, value in metrics.items():
+                optimizer_metrics[f'{metric}/{name}'] = value
 
         return optimizer_metrics
@@ -0,0 +1,96 @@
+# Copyright 2022 MosaicML Examples authors
+# SPDX-License-Identifier: Apache-2.0
+
+"""Triton implementation of the Lion update.
+
+The eager Lion update runs one elementwise kernel per operation (weight decay,
+interpolation, sign, parameter update and moment update), streaming the
+parameter, grad and moment tensors through memory several times. The kernel
+below fuses all of them so that ``p``, ``grad`` and ``exp_avg`` are each read
+once and ``p`` and ``exp_avg`` are each written once.
+"""
+
+import torch
+import triton  # type: ignore (reportMissingImports)
+import triton.language as tl  # type: ignore (reportMissingImports)
+
+
+@triton.jit
+def _lion_update_kernel(
+    p_ptr,
+    grad_ptr,
+    exp_avg_ptr,
+    lr,
+    wd_mul,
+    beta1,
+    beta2,
+    n_elements,
+    DECAY: tl.constexpr,
+    UPDATE_MOMENT: tl.constexpr,
+    BLOCK_SIZE: tl.constexpr,
+):
+    pid = tl.program_id(axis=0)
+    offsets = pid * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
+    mask = offsets < n_elements
+
+    # compute in fp32, the stores below cast back to each tensor's own dtype
+    p = tl.load(p_ptr + offsets, mask=mask).to(tl.float32)
+    grad = tl.load(grad_ptr + offsets, mask=mask).to(tl.float32)
+    exp_avg = tl.load(exp_avg_ptr + offsets, mask=mask).to(tl.float32)
+
+    # stepweight decay
+    if DECAY:
+        p = p * wd_mul
+
+    # update is the sign of the interpolation between gradient and momentum.
+    # Like torch.sign, the sign of 0 is 0 and the sign of NaN is NaN, so a NaN
+    # update ends up in `p` just as it does in the eager update
+    update = exp_avg * beta1 + grad * (1 - beta1)
+    sign = tl.where(update > 0, 1.0, tl.where(update < 0, -1.0, update))
+    p = p - lr * sign
+
+    tl.store(p_ptr + offsets, p, mask=mask)
+
+    # momentum is interp b/w gradient and itself
+    if UPDATE_MOMENT:
+        exp_avg = exp_avg * beta2 + grad * (1 - beta2)
+        tl.store(exp_avg_ptr + offsets, exp_avg, mask=mask)
+
+
+def lion_update_fn(p: torch.Tensor, grad: torch.Tensor, exp_avg: torch.Tensor,
+                   lr: float, wd_mul: float, beta1: float, beta2: float,
+                   update_moment: bool = True) -> None:
+    """Applies the Lion update to ``p`` and ``exp_avg`` in place.
+
+    All three tensors must be contiguous CUDA tensors with the same number of
+    elements. ``exp_avg`` may be stored in a lower precision than ``p``, e.g.
+    bfloat16, since all arithmetic happens in fp32.
+
+    Args:
+        p (torch.Tensor): Parameter to update.
+        grad (torch.Tensor): Gradient of ``p``.
+        exp_avg (torch.Tensor): Momentum of ``p``.
+        lr (float): Learning rate.
+        wd_mul (float): Multiplier applied to ``p`` for decoupled weight decay.
+        beta1 (float): Interpolation factor for the update direction.
+        beta2 (float): Interpolation factor for the momentum.
+        update_moment (bool): Whether to also update ``exp_avg``. Callers that
+            have already computed the new momentum can skip its write.
+    """
+    n_elements = p.numel()
+    if n_elements == 0:
+        return
+
+    grid = lambda meta: (triton.cdiv(n_elements, meta['BLOCK_SIZE']),)
+    with torch.cuda.device(p.device):
+        _lion_update_kernel[grid](p,
+                                  grad,
+                                  exp_avg,
+                                  lr,
+                                  wd_mul,
+                                  beta1,
+                                  beta2,
+                                  n_elements,
+                                  DECAY=wd_mul != 1.0,
+                                  UPDATE_MOMENT=update_moment,
+                                  BLOCK_SIZE=1024)
@@ -1,5 +1,6 @@
 
 import collections
+import math
 
 class OutlierDetector:
     """This class implements an algorithm to detect outliers in sequential numeric data (e.g. for gradient/moment norms in optimizers). It relies on a delayed moving average
@@ -16,7 +17,15 @@ class OutlierDetector:
           
         self.intermediate_data_queue = collections.deque(maxlen=delay_interval)
         self.delayed_moving_average = collections.deque(maxlen=delay_interval)
+        # running sum of `delayed_moving_average`, so that the average doesn't have to re-sum the whole window
+        self.delayed_moving_sum = 0.0
         self.threshold = threshold
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # detectors pickled before the running sum was tracked
+        if 'delayed_moving_sum' not in state:
+            self.delayed_moving_sum = float(sum(self.delayed_moving_average))
     
     def insert_observation(self, obs: float) -> bool:
         """Inserts obs into the data buffer and returns true if it is an "outlier", defined `threshold` times larger than
@@ -34,7 +43,13 @@ class OutlierDetector:
         if len(self.intermediate_data_queue) >= self.intermediate_data_queue.maxlen:
                 # move data from intermediate queue to slow moving average queue
                 intermediate_obs = self.intermediate_data_queue.popleft()
+                if len(self.delayed_moving_average) >= self.delayed_moving_average.maxlen:
+                    self.delayed_moving_sum -= self.delayed_moving_average[0]
                 self.delayed_moving_average.append(intermediate_obs)
+                self.delayed_moving_sum += intermediate_obs
+                if not math.isfinite(self.delayed_moving_sum):
+                    # evicting an inf leaves inf - inf = nan behind, so re-sum the window while it holds non-finite values
+                    self.delayed_moving_sum = float(sum(self.delayed_moving_average))
 
         self.intermediate_data_queue.append(obs)
         delayed_mva = self.get_delayed_mva()
@@ -42,6 +57,6 @@ class OutlierDetector:
          
     def get_delayed_mva(self):
         if len(self.delayed_moving_average) > 0:
-            return sum(self.delayed_moving_average) / len(self.delayed_moving_average)
+            return self.delayed_moving_sum / len(self.delayed_moving_average)
         else:
             return None
@@ -0,0 +1,424 @@
+# Copyright 2022 MosaicML Examples authors
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+
+import pytest
+import torch
+
+from examples.common.optim import (DecoupledAdaLRLion, DecoupledClipLion,
+                                   DecoupledLionW)
+from examples.common.optim.outlier_detection import OutlierDetector
+
+
+def _make_model(seed=0):
+    torch.manual_seed(seed)
+    return torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU(),
+                               torch.nn.Linear(16, 4))
+
+
+def _set_grads(model, seed):
+    generator = torch.Generator().manual_seed(seed)
+    for p in model.parameters():
+        p.grad = torch.randn(p.shape, generator=generator, dtype=p.dtype)
+
+
+@pytest.mark.parametrize(
+    'optimizer_cls', [DecoupledLionW, DecoupledAdaLRLion, DecoupledClipLion])
+def test_bf16_moment_state_dict_round_trip(optimizer_cls):
+    model = _make_model()
+    optimizer = optimizer_cls(model.parameters(), lr=1e-2, bf16_moment=True)
+    for seed in range(3):
+        _set_grads(model, seed)
+        optimizer.step()
+
+    buffer = io.BytesIO()
+    torch.save(optimizer.state_dict(), buffer)
+    buffer.seek(0)
+
+    loaded_model = _make_model()
+    loaded_model.load_state_dict(model.state_dict())
+    loaded_optimizer = optimizer_cls(loaded_model.parameters(),
+                                     lr=1e-2,
+                                     bf16_moment=True)
+    loaded_optimizer.load_state_dict(torch.load(buffer))
+
+    for p, loaded_p in zip(model.parameters(), loaded_model.parameters()):
+        exp_avg = optimizer.state[p]['exp_avg']
+        loaded_exp_avg = loaded_optimizer.state[loaded_p]['exp_avg']
+        assert loaded_exp_avg.dtype == torch.bfloat16
+        torch.testing.assert_close(loaded_exp_avg, exp_avg, rtol=0, atol=0)
+
+    # and training carries on exactly as if it had never been interrupted
+    for seed in range(3, 6):
+        _set_grads(model, seed)
+        _set_grads(loaded_model, seed)
+        optimizer.step()
+        loaded_optimizer.step()
+
+    for p, loaded_p in zip(model.parameters(), loaded_model.parameters()):
+        loaded_exp_avg = loaded_optimizer.state[loaded_p]['exp_avg']
+        assert loaded_exp_avg.dtype == torch.bfloat16
+        torch.testing.assert_close(loaded_p, p, rtol=0, atol=0)
+
+
+@pytest.mark.parametrize(
+    'optimizer_cls', [DecoupledLionW, DecoupledAdaLRLion, DecoupledClipLion])
+def test_bf16_moment_update_uses_param_precision(optimizer_cls):
+    # 1e-3 is not representable in bfloat16, so a step scaled in the moment's
+    # precision would be off by the rounding of the lr
+    lr = 1e-3
+    model = _make_model()
+    optimizer = optimizer_cls(model.parameters(), lr=lr, bf16_moment=True)
+    _set_grads(model, 0)
+    before = [p.detach().clone() for p in model.parameters()]
+    optimizer.step()
+
+    for p, p_before in zip(model.parameters(), before):
+        # the moment starts at zero, so the first step is lr * sign(grad)
+        torch.testing.assert_close(p, p_before - lr * p.grad.sign(),
+                                   rtol=0,
+                                   atol=0)
+
+
+def test_outlier_detector_running_mean():
+    detector = OutlierDetector(threshold=5.0, delay_interval=4)
+    observations = [float(i % 7 + 1) for i in range(30)]
+    for t, obs in enumerate(observations):
+        detector.insert_observation(obs)
+        # the delayed window holds the observations from steps t-7 to t-4
+        window = observations[max(0, t - 7):max(0, t - 3)]
+        if window:
+            assert detector.get_delayed_mva() == pytest.approx(
+                sum(window) / len(window))
+        else:
+            assert detector.get_delayed_mva() is None
+
+
+def test_outlier_detector_recovers_from_non_finite_observation():
+    detector = OutlierDetector(threshold=5.0, delay_interval=3)
+    for obs in [1.0] * 3 + [float('inf')] + [1.0] * 10:
+        detector.insert_observation(obs)
+
+    # the inf has left the delayed window, so outliers are detected again
+    assert detector.get_delayed_mva() == 1.0
+    assert detector.insert_observation(100.0)
+
+
+
+def test_adalr_scaled_lr_matches_adjust_lr():
+    optimizer = DecoupledAdaLRLion(_make_model().parameters(),
+                                   timeout=20,
+                                   lr_penalty=.5,
+                                   min_scale=1e-4)
+    for num_times in range(22):
+        assert optimizer._scaled_lr(1e-3, num_times) == pytest.approx(
+            DecoupledAdaLRLion.adjust_lr(1e-3, .5, num_times, 1e-4))
+
+
+class _ReferenceLion:
+    """Per-parameter implementation of the Lion variants, as they were written
+    before being vectorized, to check the optimizers against."""
+
+    def __init__(self, params, kind, lr, betas, weight_decay,
+                 outlier_threshold, timeout, lr_penalty, min_scale):
+        self.params = [p.detach().clone() for p in params]
+        self.states = [{} for _ in self.params]
+        self.kind = kind
+        self.lr, self.initial_lr = lr, lr
+        self.beta1, self.beta2 = betas
+        self.weight_decay = weight_decay
+        self.outlier_threshold = outlier_threshold
+        self.timeout = timeout
+        self.lr_penalty = lr_penalty
+        self.min_scale = min_scale
+
+    def adjust_lr(self, lr, num_times):
+        return lr * max(self.min_scale, self.lr_penalty**num_times)
+
+    def lionw(self, p, grad, exp_avg, lr):
+        if self.weight_decay != 0:
+            p.mul_(1 - (lr / self.initial_lr) * self.weight_decay)
+        update = exp_avg.lerp(grad, 1 - self.beta1).sign_()
+        p.add_(update, alpha=-lr)
+        exp_avg.lerp_(grad, 1 - self.beta2)
+
+    def step(self, grads):
+        for p, grad, state in zip(self.params, grads, self.states):
+            if len(state) == 0:
+                state['exp_avg'] = torch.zeros_like(p)
+                if self.kind == 'adalr':
+                    state['moment_tracker'] = OutlierDetector(
+                        self.outlier_threshold)
+                    state['outlier_timestamp'] = []
+                    state['step'] = 0
+                elif self.kind == 'clip':
+                    state['grad_tracker'] = OutlierDetector(
+                        self.outlier_threshold)
+                    state['clipped_batches'] = 0
+            exp_avg, lr = state['exp_avg'], self.lr
+
+            if self.kind == 'adalr':
+                moment_norm = torch.linalg.vector_norm(
+                    exp_avg.lerp(grad, 1 - self.beta2)).item()
+                if state['moment_tracker'].insert_observation(moment_norm):
+                    state['outlier_timestamp'].append(state['step'])
+                state['outlier_timestamp'] = [
+                    ts for ts in state['outlier_timestamp']
+                    if state['step'] - ts <= self.timeout
+                ]
+                lr = self.adjust_lr(lr, len(state['outlier_timestamp']))
+            elif self.kind == 'clip':
+                grad_norm = torch.linalg.vector_norm(grad).item()
+                if state['grad_tracker'].insert_observation(grad_norm):
+                    state['clipped_batches'] += 1
+                    clip_norm = state['grad_tracker'].get_delayed_mva(
+                    ) * self.outlier_threshold
+                    grad = grad.div(grad_norm).mul_(clip_norm)
+
+            self.lionw(p, grad, exp_avg, lr)
+            if self.kind == 'adalr':
+                state['step'] += 1
+
+    def metrics(self, i, grad, name):
+        p, state = self.params[i], self.states[i]
+        exp_avg = state['exp_avg']
+        step_tensor = exp_avg.clone().lerp_(grad, 1 - self.beta1).sign_().mul_(
+            self.lr)
+        step_tensor.add_(p,
+                         alpha=-self.weight_decay * self.lr / self.initial_lr)
+        cosine = torch.nn.functional.cosine_similarity
+        metrics = {
+            f'l2_norm/moment/{name}':
+                torch.linalg.vector_norm(exp_avg),
+            f'l2_norm/param/{name}':
+                torch.linalg.vector_norm(p),
+            f'l2_norm/update/{name}':
+                torch.linalg.vector_norm(step_tensor),
+            f'l2_norm/grad/{name}':
+                torch.linalg.vector_norm(grad),
+            f'cosine/update_grad/{name}':
+                cosine(grad.flatten(), step_tensor.flatten(), dim=0),
+            f'cosine/moment_grad/{name}':
+                cosine(grad.flatten(), exp_avg.flatten(), dim=0),
+        }
+        if self.kind == 'adalr':
+            metrics[f'layerwise_lr/{name}'] = torch.tensor(
+                self.adjust_lr(self.lr, len(state['outlier_timestamp'])))
+        elif self.kind == 'clip':
+            metrics[f'clipped_batches/{name}'] = torch.tensor(
+                float(state['clipped_batches']))
+        return metrics
+
+
+# the outlier detectors only have a delayed moving average after 500 steps
+_NUM_STEPS = 520
+_OUTLIER_STEP = 510
+
+
+def _check_matches_reference(model, optimizer, reference, grads):
+    names = [name for name, _ in model.named_parameters()]
+    params = list(model.parameters())
+    for p, reference_p, reference_state in zip(params, reference.params,
+                                               reference.states):
+        torch.testing.assert_close(p.detach(), reference_p)
+        torch.testing.assert_close(optimizer.state[p]['exp_avg'],
+                                   reference_state['exp_avg'])
+
+    metrics, reference_metrics = {}, {}
+    for i, (name, p) in enumerate(zip(names, params)):
+        metrics = optimizer.report_per_parameter_metrics(p, name, metrics)
+        reference_metrics.update(reference.metrics(i, grads[i], name))
+    metrics = optimizer.dist_reduce_metrics(
+        optimizer.pre_reduce_metrics(metrics))
+
+    assert metrics.keys() == reference_metrics.keys()
+    for metric, value in reference_metrics.items():
+        torch.testing.assert_close(torch.as_tensor(metrics[metric]).double(),
+                                   value.double(),
+                                   msg=metric)
+
+
+@pytest.mark.parametrize('kind', ['lionw', 'adalr', 'clip'])
+@pytest.mark.parametrize('weight_decay', [0.0, 0.1])
+def test_matches_per_parameter_reference(kind, weight_decay):
+    lr, betas = 1e-2, (0.9, 0.99)
+    outlier_kwargs = dict(outlier_threshold=5.0,
+                          timeout=5,
+                          lr_penalty=.707,
+                          min_scale=1e-4)
+    model = _make_model().double()
+    if kind == 'lionw':
+        optimizer = DecoupledLionW(model.parameters(),
+                                   lr=lr,
+                                   betas=betas,
+                                   weight_decay=weight_decay)
+    elif kind == 'adalr':
+        optimizer = DecoupledAdaLRLion(model.parameters(),
+                                       lr=lr,
+                                       betas=betas,
+                                       weight_decay=weight_decay,
+                                       **outlier_kwargs)
+    else:
+        optimizer = DecoupledClipLion(
+            model.parameters(),
+            lr=lr,
+            betas=betas,
+            weight_decay=weight_decay,
+            outlier_threshold=outlier_kwargs['outlier_threshold'])
+    reference = _ReferenceLion(model.parameters(), kind, lr, betas,
+                               weight_decay, **outlier_kwargs)
+
+    for step in range(_NUM_STEPS):
+        # decay the lr, so that the weight decay is scaled relative to the
+        # initial lr
+        scheduled_lr = lr * (1 - step / (2 * _NUM_STEPS))
+        optimizer.param_groups[0]['lr'] = scheduled_lr
+        reference.lr = scheduled_lr
+
+        _set_grads(model, step)
+        if step == _OUTLIER_STEP:
+            for p in model.parameters():
+                p.grad.mul_(1000)
+        grads = [p.grad.clone() for p in model.parameters()]
+
+        optimizer.step()
+        reference.step(grads)
+
+        if step == _OUTLIER_STEP:
+            # make sure the outlier was actually detected
+            if kind == 'adalr':
+                assert all(
+                    len(state['outlier_timestamp']) == 1
+                    for state in reference.states)
+            elif kind == 'clip':
+                assert all(state['clipped_batches'] == 1
+                           for state in reference.states)
+
+        if step in (0, _OUTLIER_STEP, _NUM_STEPS - 1):
+            _check_matches_reference(model, optimizer, reference, grads)
+
+
+def test_base_outlier_lion_is_abstract():
+    from examples.common.optim.adaptive_lion import BaseOutlierLion
+
+    with pytest.raises(TypeError):
+        BaseOutlierLion(_make_model().parameters())
+
+
+def _triton_and_eager_lion_update(monkeypatch, p, grad, exp_avg, wd_mul,
+                                  update_moment):
+    from examples.common.optim import lion
+    from examples.common.optim.lion_triton import lion_update_fn
+
+    lr, beta1, beta2 = 1e-2, 0.9, 0.99
+    triton_p, triton_exp_avg = p.clone(), exp_avg.clone()
+    lion_update_fn(triton_p,
+                   grad,
+                   triton_exp_avg,
+                   lr,
+                   wd_mul,
+                   beta1,
+                   beta2,
+                   update_moment=update_moment)
+
+    # without the kernel, _multi_tensor_lionw falls back to the eager update
+    monkeypatch.setattr(lion, 'lion_update_fn', None)
+    eager_p, eager_exp_avg = p.clone(), exp_avg.clone()
+    lion._multi_tensor_lionw([eager_p], [grad], [eager_exp_avg], [lr],
+                             lr,
+                             1 - wd_mul,
+                             beta1,
+                             beta2,
+                             update_moment=update_moment)
+    return triton_p, triton_exp_avg, eager_p, eager_exp_avg
+
+
+@pytest.mark.gpu
+@pytest.mark.parametrize('moment_dtype', [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize('wd_mul', [1.0, 0.99])
+@pytest.mark.parametrize('update_moment', [True, False])
+def test_lion_triton_matches_eager(moment_dtype,
+                                   wd_mul,
+                                   update_moment,
+                                   monkeypatch,
+                                   device='cuda'):
+    generator = torch.Generator(device).manual_seed(0)
+    # not a multiple of the kernel's block size, so the masking is exercised
+    shape = (37, 111)
+    p = torch.randn(shape, device=device, generator=generator)
+    grad = torch.randn(shape, device=device, generator=generator)
+    exp_avg = torch.randn(shape, device=device,
+                          generator=generator).to(moment_dtype)
+
+    triton_p, triton_exp_avg, eager_p, eager_exp_avg = (
+        _triton_and_eager_lion_update(monkeypatch, p, grad, exp_avg, wd_mul,
+                                      update_moment))
+
+    torch.testing.assert_close(triton_p, eager_p)
+    if not update_moment:
+        torch.testing.assert_close(triton_exp_avg, exp_avg, rtol=0, atol=0)
+    elif moment_dtype == torch.bfloat16:
+        # the kernel rounds the new moment to bfloat16 once, the eager update
+        # rounds after each of its two operations
+        torch.testing.assert_close(triton_exp_avg,
+                                   eager_exp_avg,
+                                   rtol=2**-7,
+                                   atol=2**-6)
+    else:
+        torch.testing.assert_close(triton_exp_avg, eager_exp_avg)
+
+
+@pytest.mark.gpu
+def test_lion_triton_propagates_nan(monkeypatch, device='cuda'):
+    p = torch.ones(4, device=device)
+    grad = torch.tensor([float('nan'), 0.0, 1.0, -1.0], device=device)
+    exp_avg = torch.zeros(4, device=device)
+
+    triton_p, triton_exp_avg, eager_p, eager_exp_avg = (
+        _triton_and_eager_lion_update(monkeypatch, p, grad, exp_avg, 0.99,
+                                      True))
+
+    # a NaN update diverges the param instead of silently skipping it, and a
+    # zero update leaves it as it is, apart from the weight decay
+    assert triton_p[0].isnan() and eager_p[0].isnan()
+    torch.testing.assert_close(triton_p, eager_p, equal_nan=True)
+    torch.testing.assert_close(triton_exp_avg, eager_exp_avg, equal_nan=True)
+
+
+@pytest.mark.gpu
+@pytest.mark.parametrize('moment_dtype', [torch.float32, torch.bfloat16])
+def test_multi_tensor_lionw_mixed_sizes(moment_dtype,
+                                        monkeypatch,
+                                        device='cuda'):
+    from examples.common.optim import lion
+
+    generator = torch.Generator(device).manual_seed(0)
+    # one param large enough for the Triton kernel, small ones that go through
+    # the multi-tensor kernels, and a large non-contiguous one that has to
+    shapes = [(1024, 1025), (16,), (16, 8), (1024, 1025)]
+    params = [
+        torch.randn(shape, device=device, generator=generator)
+        for shape in shapes
+    ]
+    params[-1] = params[-1].t()
+    grads = [torch.randn_like(p) for p in params]
+    exp_avgs = [torch.randn_like(p).to(moment_dtype) for p in params]
+    lrs = [1e-2, 1e-2, 5e-3, 1e-2]
+
+    def run():
+        ps = [p.clone() for p in params]
+        ms = [m.clone() for m in exp_avgs]
+        lion._multi_tensor_lionw(ps, grads, ms, lrs, 1e-2, 0.1, 0.9, 0.99)
+        return ps, ms
+
+    triton_params, triton_exp_avgs = run()
+    monkeypatch.setattr(lion, 'lion_update_fn', None)
+    eager_params, eager_exp_avgs = run()
+
+    tolerances = dict(rtol=2**-7,
+                      atol=2**-6) if moment_dtype == torch.bfloat16 else {}
+    for triton_p, eager_p in zip(triton_params, eager_params):
+        torch.testing.assert_close(triton_p, eager_p)
+    for triton_exp_avg, eager_exp_avg in zip(triton_exp_avgs, eager_exp_avgs):
+        torch.testing.assert_close(triton_exp_avg, eager_exp_avg, **tolerances)